@@ -52,6 +52,11 @@ class Model:
         raise NotImplementedError
 
     def predict_and_save(self, fn, *datas):
+        """
+        Predict and save the result to 'fn'. The arrays in 'datas' are
+        read-only as they are shared between models, `predict` must copy
+        any array it needs to modify.
+        """
         result = self.predict(*datas)
 
         if result is None:
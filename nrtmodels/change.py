@@ -100,6 +100,8 @@ class CloudAndShadowDetect(Model):
 
     def predict(self, mask, ref, obs):
         bad = np.logical_or(~np.isfinite(ref), ~np.isfinite(obs)).any(axis=2)
+        ref = ref.copy()
+        obs = obs.copy()
         ref[bad] = np.nan
         obs[bad] = np.nan
 
@@ -14,31 +14,46 @@ from posixpath import expanduser
 import numpy as np
 import argparse
 import hashlib
+import importlib
 import joblib
 import psutil
+import tempfile
 import uuid
 import yaml
 import sys
 import os
 import re
 
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, gdal_array, ogr, osr
+from joblib import Parallel, delayed
 from datetime import datetime
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from copy import deepcopy
 from pydoc import locate
-from io import BytesIO
 
 gdal.UseExceptions()
 ogr.UseExceptions()
 osr.UseExceptions()
 
-gdal.PushErrorHandler("CPLQuietErrorHandler")
+
+def quiet_gdal_errors():
+    """
+    Silence GDAL error messages. GDAL error handlers are per thread so this is
+    also used as the initializer of the thread pools.
+    """
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+
+
+quiet_gdal_errors()
 
 np.set_printoptions(precision=4, linewidth=120, suppress=True, sign='+')
 
 DEBUG = False
 
+PROCESS = None
+
 MODELDIR = "nrtmodels"
 
 RST = "\033[0m"
@@ -46,6 +61,23 @@ RED = "\033[38;5;9m"
 GREEN = "\033[38;5;10m"
 BLUE = "\033[38;5;4m"
 
+WKTNUMBER = re.compile(r"([+-]?\d*\.\d{4})\d*")
+
+# GDAL configuration defaults, these are only applied if they are not set in
+# the environment or in the 'gdalconfig' section of the configuration.
+
+GDAL_DEFAULTS = [
+    ("GDAL_CACHEMAX", "2048"),
+    ("GDAL_DISABLE_READDIR_ON_OPEN", "YES"),
+    ("GDAL_INGESTED_BYTES_AT_OPEN", "32768"),
+    ("GDAL_HTTP_MULTIPLEX", "YES"),
+    ("GDAL_HTTP_VERSION", "2"),
+    ("CPL_VSIL_CURL_CHUNK_SIZE", "10485760"),
+    ("VSI_CACHE", "TRUE"),
+    ("VSI_CACHE_SIZE", "268435456"),
+    ("VRT_SHARED_SOURCE", "0"),
+]
+
 
 class URLParsingError(ValueError):
     """
@@ -61,7 +93,7 @@ class InputDataError(ValueError):
 
 class IncorrectChecksumError(IOError):
     """
-    Raised if the model SHA256 checksum doesn't match what is expected.
+    Raised if the model checksum doesn't match what is expected.
     """
 
 
@@ -88,12 +120,29 @@ class DEASentinel2(Source):
     def openfile(self, fn: str):
         return gdal.Open(fn)
 
-    def get_observations(self, url: str, product: str = "NBART", onlymask: bool = False, **args) -> tuple:
+    def get_observations(
+        self,
+        url: str,
+        product: str = "NBART",
+        onlymask: bool = False,
+        pool: ThreadPoolExecutor = None,
+        nthreads: int = None,
+        **args,
+    ) -> tuple:
         """
         Get the NRT observation from the S3 or public (HTTP) bucket and load the
-        data into memory in a numpy array of shape (ysize, xsize, nbands). This is
-        assuming the DEA package format.
+        data into memory in a numpy array of shape (nbands, ysize, xsize). This is
+        assuming the DEA package format. The bands are read using the 'nthreads'
+        threads in 'pool' (by default a thread per band), a pool is created if one
+        is not given.
         """
+        if nthreads is None:
+            nthreads = len(self.bands)
+
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=nthreads, initializer=quiet_gdal_errors) as pool:
+                return self.get_observations(url, product, onlymask, pool, nthreads, **args)
+
         bands = args.pop("bands_required", self.bands)
 
         pkg = parse_pkg(url)
@@ -111,14 +160,17 @@ class DEASentinel2(Source):
         fd = self.openfile(fn)
         mask = fd.ReadAsArray()
 
-        pnodata = np.count_nonzero(mask == 0) / np.prod(mask.shape)
-        pclear = np.count_nonzero(mask == 1) / np.prod(mask.shape)
+        counts = count_classes(mask)
+        pnodata = counts[0] / mask.size
+        pclear = counts[1] / mask.size
 
         log(f"Package:   {pkg}")
         log(f"Thumbnail: {stripped_url}/{product}/{product}_THUMBNAIL.JPG")
         log(f"Location:  {stripped_url}/map.html")
         log(f"Pixels:    {mask.shape[0]} x {mask.shape[1]}")
         log(f"Clear %:   {pclear:.4f}")
+        log(f"Nodata %:  {pnodata:.4f}")
+        log(f"Classes:   {counts}")
 
         geo = fd.GetGeoTransform()
         prj = fd.GetProjection()
@@ -142,16 +194,63 @@ class DEASentinel2(Source):
 
         # Load other bands
 
-        data = np.empty((ysize, xsize, len(bands)), dtype=np.float32)
-        for i, band in enumerate(bands):
-            fn = f"{url}/{product}/{bfm[band]}"
-            fd = self.openfile(fn)
-            fd.ReadAsArray(buf_obj=data[:, :, i], buf_ysize=ysize, buf_xsize=xsize)
-            hc = checksum_array(data[:, :, i])
-            log(f" {band} (sha256:{hc})")
+        # Stack the bands in a VRT on the grid of the mask so that all of them
+        # are read with a single call. The rows are split into stripes which are
+        # read concurrently, each with its own handle on the VRT, as the reads
+        # are mostly waiting on the network and GDAL releases the GIL while
+        # reading.
 
-        nodata = fd.GetRasterBand(1).GetNoDataValue()
-        data[data == nodata] = np.nan
+        vrtfn = f"/vsimem/{uuid.uuid4()}.vrt"
+        try:
+            bounds = (geo[0], geo[3] + ysize * geo[5], geo[0] + xsize * geo[1], geo[3])
+            fd = gdal.BuildVRT(
+                vrtfn,
+                [f"{url}/{product}/{bfm[band]}" for band in bands],
+                separate=True,
+                outputBounds=bounds,
+                xRes=geo[1],
+                yRes=-geo[5],
+            )
+            nodatas = [fd.GetRasterBand(i + 1).GetNoDataValue() for i in range(len(bands))]
+            fd = None
+
+            data = np.empty((len(bands), ysize, xsize), dtype=np.float32)
+
+            # There is a stripe per thread so that even a single band is read
+            # concurrently. The stripes are a whole number of blocks of the
+            # bands so that no block is fetched and decoded by two stripes.
+
+            def block_height(band):
+                bfd = self.openfile(f"{url}/{product}/{bfm[band]}")
+                bgeo = bfd.GetGeoTransform()
+                return max(1, round(bfd.GetRasterBand(1).GetBlockSize()[1] * bgeo[5] / geo[5]))
+
+            blocky = max(pool.map(block_height, bands))
+            height = -(-ysize // nthreads)
+            height = -(-height // blocky) * blocky
+
+            def read_stripe(yoff):
+                ycount = min(height, ysize - yoff)
+                fd = self.openfile(vrtfn)
+                fd.ReadAsArray(0, yoff, xsize, ycount, buf_obj=data[:, yoff : yoff + ycount, :])
+
+            # The nodata values are set to NaN while each band is still in cache
+            # rather than in a separate pass over the whole array.
+
+            def finish_band(i):
+                bdata = data[i]
+                hc = checksum_array(bdata)
+                if nodatas[i] is not None:
+                    bdata[bdata == nodatas[i]] = np.nan
+                return hc
+
+            list(pool.map(read_stripe, range(0, ysize, height)))
+            hcs = list(pool.map(finish_band, range(len(bands))))
+        finally:
+            gdal.Unlink(vrtfn)
+
+        for band, hc in zip(bands, hcs):
+            log(f" {band} (sha256:{hc})")
 
         log(f"\nShape: {data.shape}")
 
@@ -256,31 +355,70 @@ def checksum_array(arr: np.ndarray) -> str:
     return hasher.hexdigest()
 
 
-def checksum_file(f, blocksize: int = 2 << 15) -> str:
+def count_classes(mask: np.ndarray, blocksize: int = 256) -> np.ndarray:
     """
-    Checksum a file-like object.
+    Count the number of pixels of each class in an integer 'mask' in a single
+    pass. The mask is processed in blocks of 'blocksize' rows so that the
+    temporaries stay small.
     """
-    hasher = hashlib.sha256()
-    for block in iter(lambda: f.read(blocksize), b""):
-        hasher.update(block)
+    counts = np.zeros(2, dtype=np.int64)
+    for i in range(0, mask.shape[0], blocksize):
+        block = np.bincount(mask[i : i + blocksize].ravel())
+        if len(block) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(block) - len(counts), dtype=np.int64)])
+        counts[: len(block)] += block
+    return counts
+
+
+def get_hasher(algo: str = "sha256"):
+    """
+    Get a hasher for the algorithm 'algo'. Any algorithm provided by hashlib
+    can be used, as well as 'blake3' if the blake3 package is installed. Raises
+    a 'ValueError' if the algorithm is not available or has a variable length
+    digest (e.g. 'shake_128').
+    """
+    if algo == "blake3":
+        try:
+            from blake3 import blake3
+        except ImportError:
+            raise ValueError("the 'blake3' package is required for blake3 checksums")
+        return blake3()
+    hasher = hashlib.new(algo)
+    if hasher.digest_size == 0:
+        raise ValueError(f"variable length checksum algorithm '{algo}' is not supported")
+    return hasher
+
+
+def checksum_file(f, blocksize: int = 2 << 22, algo: str = "sha256") -> str:
+    """
+    Checksum a file-like object and rewind it afterwards. The 'blocksize' is
+    only used on Python < 3.11 where 'hashlib.file_digest' is not available.
+    """
+    if hasattr(hashlib, "file_digest"):
+        hasher = hashlib.file_digest(f, lambda: get_hasher(algo))
+    else:
+        hasher = get_hasher(algo)
+        for block in iter(lambda: f.read(blocksize), b""):
+            hasher.update(block)
     f.seek(0)
     return hasher.hexdigest()
 
 
-def check_checksum(f, checksum: str, blocksize: int = 2 << 15):
+def check_checksum(f, checksum: str, blocksize: int = 2 << 22, algo: str = "sha256"):
     """
-    Check that the SHA256 checksum of a file-type object matches the 'checksum'. Raises
-    an 'IncorrectChecksumError' if they don't match.
+    Check that the checksum of a file-type object matches the 'checksum'. Raises
+    an 'IncorrectChecksumError' if they don't match. The checksum is SHA256 unless
+    another 'algo' is given.
 
     Checksums can be generated on the command line with:
 
       % shasum -a 256 filename
 
     """
-    actual = checksum_file(f)
+    actual = checksum_file(f, blocksize, algo)
 
-    log(f"Expected SHA256 checksum: {checksum}")
-    log(f"Actual SHA256 checksum: {actual}")
+    log(f"Expected {algo.upper()} checksum: {checksum}")
+    log(f"Actual {algo.upper()} checksum: {actual}")
 
     if actual != checksum:
         raise IncorrectChecksumError()
@@ -288,7 +426,26 @@ def check_checksum(f, checksum: str, blocksize: int = 2 << 15):
     log("Checksum matches.")
 
 
-# TODO: path@sha256:123123 format?
+def same_file(a: os.stat_result, b: os.stat_result) -> bool:
+    """
+    Check that two stat results refer to the same, unmodified, file.
+    """
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    return key(a) == key(b)
+
+
+def parse_checksum(name: str) -> tuple:
+    """
+    Split a model name of the form 'path:checksum' or 'path:algo=checksum' into
+    (path, algo, checksum). The algorithm defaults to SHA256.
+    """
+    path, checksum = name.split(":")
+    algo = "sha256"
+    if "=" in checksum:
+        algo, checksum = checksum.split("=")
+    return path, algo, checksum
 
 
 def get_model(name: str, **config):
@@ -298,32 +455,42 @@ def get_model(name: str, **config):
     the current directory, the case where a direct path to a pickled
     model is given, and the case where the model is stored in a public
     s3 bucket.
+
+    The numpy arrays of a model loaded from a path are memory mapped, so
+    they are not pinned to the bytes that were checksummed and will reflect
+    any later change to the file while the model is in use.
     """
     # Handle case where name is a path a pickled model on disk
 
     if name[:7] == "file://":
-        path = name[7:]
-        path, checksum = path.split(":")
+        path, algo, checksum = parse_checksum(name[7:])
         log(f"Loading model from '{path}'")
-        with open(path, "rb") as df:
-            f = BytesIO(df.read())
-            check_checksum(f, checksum)
-            f.seek(0)
-            model = joblib.load(f)
-            model.update(**config)
+        with open(path, "rb") as f:
+            check_checksum(f, checksum, algo=algo)
+            # Load by path so that the numpy arrays of the model are memory
+            # mapped rather than copied into memory. Refuse the model if the
+            # path does not refer to the verified file, unchanged, both
+            # before and after loading it.
+            verified = os.fstat(f.fileno())
+            if not same_file(verified, os.stat(path)):
+                raise IncorrectChecksumError(f"'{path}' changed after its checksum was verified")
+            model = joblib.load(path, mmap_mode="r")
+            if not (same_file(verified, os.stat(path)) and same_file(verified, os.fstat(f.fileno()))):
+                raise IncorrectChecksumError(f"'{path}' changed while it was being loaded")
+        model.update(**config)
 
     # Handle model stored in a s3 bucket
 
     elif name[:5] == "s3://":
         log(f"Loading model from '{name}'")
-        bucket, key = name.split("/")[2], name.split("/")[3:]
+        path, algo, checksum = parse_checksum(name[5:])
+        bucket, key = path.split("/")[0], path.split("/")[1:]
         key = "/".join(key)
-        with BytesIO() as f:
+        with tempfile.TemporaryFile() as f:
             s3 = get_s3_client()
             s3.download_fileobj(Bucket=bucket, Key=key, Fileobj=f)
             f.seek(0)
-            # check_checksum(f, checksum)
-            f.seek(0)
+            check_checksum(f, checksum, algo=algo)
             model = joblib.load(f)
             model.update(**config)
 
@@ -383,7 +550,7 @@ def wktfmt(wkt: str) -> str:
     """
     Round numbers in WKT str to 4 decimal places of accuracy.
     """
-    return re.sub(r"([+-]*\d*\.\d\d\d\d)(\d*)", r"\1", wkt)
+    return WKTNUMBER.sub(r"\1", wkt)
 
 
 def sizefmt(num: int, suffix="B") -> str:
@@ -397,20 +564,27 @@ def sizefmt(num: int, suffix="B") -> str:
     return "%.1f%s%s" % (num, "Yi", suffix)
 
 
+def get_process() -> psutil.Process:
+    """
+    Get the psutil handle of the current process. This is cached but checked
+    against the pid in case we are in a forked worker.
+    """
+    global PROCESS
+    if PROCESS is None or PROCESS.pid != os.getpid():
+        PROCESS = psutil.Process()
+    return PROCESS
+
+
 def log(msg: str = "", noinfo: bool = False, color=GREEN):
     """
     Log a message.
     """
-    pid = os.getpid()
-    process = psutil.Process(pid)
-    mem = psutil.virtual_memory()
-    used = sizefmt(mem.total - mem.available)
-    rss = sizefmt(process.memory_info().rss)
-    if noinfo:
+    header = isinstance(msg, str) and msg.startswith("#")
+    if noinfo or not (header or DEBUG):
         mem = ""
     else:
-        mem = f"[MEM {rss}]"
-    if isinstance(msg, str) and msg.startswith("#"):
+        mem = f"[MEM {sizefmt(get_process().memory_info().rss)}]"
+    if header:
         msg = "\n" + color + str(msg) + RST + " " + mem + "\n"
     elif isinstance(msg, str) and msg.startswith("@"):
         msg = BLUE + msg[1:] + RST
@@ -429,19 +603,34 @@ def warning(msg: str):
     print("\n" + RED + str(msg) + RST, file=sys.stderr)
 
 
+@lru_cache(maxsize=32)
+def parse_url(url: str) -> tuple:
+    """
+    Parse the package name and the observation date from url.
+    """
+    pkg = [x for x in url.split("/") if len(x) > 0][-1]
+    try:
+        obsdate = datetime.strptime(pkg.split("_")[6], "%Y%m%dT%H%M%S")
+    except (IndexError, ValueError):
+        obsdate = None
+    return pkg, obsdate
+
+
 def parse_pkg(url: str) -> str:
     """
     Package name parsing.
     """
-    return [x for x in url.split("/") if len(x) > 0][-1]
+    return parse_url(url)[0]
 
 
 def parse_obsdate(url: str) -> str:
     """
     Parse observation date from url.
     """
-    pkg = parse_pkg(url)
-    return datetime.strptime(pkg.split("_")[6], "%Y%m%dT%H%M%S")
+    obsdate = parse_url(url)[1]
+    if obsdate is None:
+        raise URLParsingError(f"Cannot parse the observation date from {url}")
+    return obsdate
 
 
 def get_bounds(url: str) -> str:
@@ -467,13 +656,18 @@ def polygon_from_geobox(geo: tuple, xsize: int, ysize: int):
     """
     Generate a polygon from a geobox and the number of pixels.
     """
-    poly = ogr.Geometry(ogr.wkbPolygon)
+    ox, px, rx, oy, ry, py = geo
+    corners = [
+        (ox, oy),
+        (ox + xsize * px, oy + xsize * ry),
+        (ox + xsize * px + ysize * rx, oy + xsize * ry + ysize * py),
+        (ox + ysize * rx, oy + ysize * py),
+        (ox, oy),
+    ]
     ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(geo[0] + 0 * geo[1] + 0 * geo[2], geo[3] + 0 * geo[4] + 0 * geo[5])
-    ring.AddPoint(geo[0] + xsize * geo[1] + 0 * geo[2], geo[3] + xsize * geo[4] + 0 * geo[5])
-    ring.AddPoint(geo[0] + xsize * geo[1] + ysize * geo[2], geo[3] + 0 * geo[4] + ysize * geo[5])
-    ring.AddPoint(geo[0] + 0 * geo[1] + ysize * geo[2], geo[3] + 0 * geo[4] + ysize * geo[5])
-    ring.AddPoint(geo[0] + 0 * geo[1] + 0 * geo[2], geo[3] + 0 * geo[4] + 0 * geo[5])
+    for x, y in corners:
+        ring.AddPoint(x, y)
+    poly = ogr.Geometry(ogr.wkbPolygon)
     poly.AddGeometry(ring)
     return poly
 
@@ -514,20 +708,135 @@ def generate_clip_shape_from(fn: str, shpfn: str) -> str:
     return shpfn
 
 
+def warp_ancillary(afn: str, ofn: str, clipshpfn: str, obsprj: str, obspoly) -> str:
+    """
+    Clip and warp the ancillary raster 'afn' to the area of the observation and
+    save it as 'ofn'. Raises an 'InputDataError' if 'afn' does not intersect the
+    observation.
+    """
+    fd = gdal.Open(afn)
+    geo = fd.GetGeoTransform()
+    prj = fd.GetProjection()
+
+    obssr = osr.SpatialReference()
+    obssr.ImportFromProj4(obsprj)
+
+    insr = osr.SpatialReference()
+    insr.ImportFromProj4(prj)
+
+    insr_to_obssr = osr.CoordinateTransformation(insr, obssr)
+    poly = polygon_from_geobox(geo, fd.RasterXSize, fd.RasterYSize)
+    poly.Transform(insr_to_obssr)
+
+    if not poly.Intersects(obspoly):
+        raise InputDataError(f"Input data '{afn}' does not intersect observation.")
+
+    log(f"Clipping and warping input '{afn}' to '{ofn}'")
+
+    fd = gdal.Warp(
+        ofn,
+        fd,
+        cutlineDSName=clipshpfn,
+        cropToCutline=True,
+        dstSRS=obsprj,
+        warpOptions=["NUM_THREADS=1"],
+    )
+
+    return ofn
+
+
+def load_raster(fn: str, xsize: int, ysize: int) -> tuple:
+    """
+    Load all the bands of the raster 'fn' at a size of 'xsize' x 'ysize' into a
+    read-only array of shape (nbands, ysize, xsize). Rasters with 8 or 16 bit
+    integer data are kept in their native type to save memory (see `as_float`),
+    anything else is loaded as float32 with the no data set to NaN. Returns the
+    array, its no data value (None if already set to NaN), the band descriptions,
+    the geotransform, and the fraction of no data.
+    """
+    fd = gdal.Open(fn)
+
+    nodata = fd.GetRasterBand(1).GetNoDataValue()
+
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(fd.GetRasterBand(1).DataType))
+    if dtype.kind not in "iu" or dtype.itemsize > 2:
+        dtype = np.dtype(np.float32)
+
+    data = np.empty((fd.RasterCount, ysize, xsize), dtype=dtype)
+    fd.ReadAsArray(buf_xsize=xsize, buf_ysize=ysize, buf_obj=data)
+
+    if dtype == np.float32:
+        data[data == nodata] = np.nan
+        nodata = None
+
+    # The fraction of no data is only used for a warning so it is estimated
+    # from every 4th pixel in each direction.
+
+    sample = data[:, ::4, ::4]
+    bad = np.isnan(sample) if nodata is None else sample == nodata
+    pnan = np.count_nonzero(bad) / bad.size
+
+    data.setflags(write=False)
+
+    descs = [fd.GetRasterBand(i + 1).GetDescription() for i in range(fd.RasterCount)]
+
+    return data, nodata, descs, fd.GetGeoTransform(), pnan
+
+
+def as_float(data: np.ndarray, nodata=None, scale=None) -> np.ndarray:
+    """
+    Convert 'data' to float32 with 'nodata' set to NaN and multiplied by 'scale'.
+    Float32 data with nothing to convert is returned as is.
+    """
+    if data.dtype == np.float32 and nodata is None and scale is None:
+        return data
+    result = data.astype(np.float32)
+    if scale is not None:
+        result *= scale
+    if nodata is not None:
+        result[data == nodata] = np.nan
+    return result
+
+
 def run(
     url=None,
     obstmp=None,
+    masktmp="mask.tif",
     clipshpfn=None,
     inputs=None,
     tmpdir=None,
     models=None,
     nocleanup=False,
+    pool=None,
+    nthreads=None,
     **args,
 ):
     """
     Load and prepare the data required for the change detection algorithms
     and then pass this data to the algorithm. Use `args` to parametrise.
+
+    The threads in 'pool' are used by all the stages of the processing, a pool
+    of 'nthreads' threads (by default one per CPU) is created if one is not
+    given.
     """
+    if nthreads is None:
+        nthreads = os.cpu_count()
+
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=nthreads, initializer=quiet_gdal_errors) as pool:
+            return run(
+                url=url,
+                obstmp=obstmp,
+                masktmp=masktmp,
+                clipshpfn=clipshpfn,
+                inputs=inputs,
+                tmpdir=tmpdir,
+                models=models,
+                nocleanup=nocleanup,
+                pool=pool,
+                nthreads=nthreads,
+                **args,
+            )
 
     log("# Loading models")
 
@@ -544,15 +853,9 @@ def run(
 
         log(f"Model: {name} -> {outfn}")
 
-        try:
-
-            model = get_model(name, **config)
-            if model.verbose:
-                model.log = log
-
-        except IncorrectChecksumError as e:
-            warning(f"Model has an incorrect SHA256 checksum, exiting...")
-            sys.exit(1)
+        model = get_model(name, **config)
+        if model.verbose:
+            model.log = log
 
         loaded_models.append(model)
 
@@ -594,17 +897,17 @@ def run(
         # get at least one band
         bands = ["B02"]
 
-    obsgeo, obsprj, obsdata, mask = source.get_observations(url, bands_required=bands)
+    obsgeo, obsprj, obsdata, mask = source.get_observations(url, bands_required=bands, pool=pool, nthreads=nthreads)
 
     ysize, xsize = mask.shape
     obspoly = polygon_from_geobox(obsgeo, xsize, ysize)
 
     log(f"# Preparing ancillary data")
 
-    log(f"Writing mask to mask.tif")
+    log(f"Writing mask to {masktmp}")
 
     driver = gdal.GetDriverByName("GTiff")
-    fd = driver.Create("mask.tif", xsize, ysize, 1, gdal.GDT_Byte)
+    fd = driver.Create(masktmp, xsize, ysize, 1, gdal.GDT_Byte)
     fd.SetGeoTransform(obsgeo)
     fd.SetProjection(obsprj)
     ob = fd.GetRasterBand(1)
@@ -612,19 +915,31 @@ def run(
     ob.SetNoDataValue(0)
     del fd
 
-    ysize, xsize, psize = obsdata.shape
+    psize, ysize, xsize = obsdata.shape
 
     log(f"Writing observation data to {obstmp}. Data has {psize} bands.")
 
+    # Write all the bands in one call to a tiled and compressed file, ZSTD is
+    # used if GDAL has been built with it.
+
     driver = gdal.GetDriverByName("GTiff")
-    fd = driver.Create(obstmp, xsize, ysize, psize, gdal.GDT_Float32)
+    compress = "ZSTD" if "ZSTD" in driver.GetMetadataItem("DMD_CREATIONOPTIONLIST") else "DEFLATE"
+    options = [
+        "TILED=YES",
+        "BLOCKXSIZE=512",
+        "BLOCKYSIZE=512",
+        f"COMPRESS={compress}",
+        f"NUM_THREADS={nthreads}",
+        "BIGTIFF=IF_SAFER",
+    ]
+    fd = driver.Create(obstmp, xsize, ysize, psize, gdal.GDT_Float32, options=options)
     fd.SetGeoTransform(obsgeo)
     fd.SetProjection(obsprj)
     for i in range(fd.RasterCount):
         ob = fd.GetRasterBand(i + 1)
-        ob.WriteArray(obsdata[:, :, i])
         ob.SetNoDataValue(np.nan)
         ob.SetDescription(bands[i])
+    fd.WriteArray(obsdata)
     del fd
 
     log(f"Determining ancillary files required")
@@ -648,9 +963,9 @@ def run(
 
     log(f"# Warping and clipping ancillary data")
 
-    # Get the unique inputs
+    # Get the unique inputs (in the order they are first used)
 
-    inputfns = [*{*inputfns}]
+    inputfns = list(dict.fromkeys(inputfns))
 
     if len(inputfns) > 0:
         log("Determining clip area from NRT observation")
@@ -663,33 +978,25 @@ def run(
     else:
         log(f"No ancillary datas are required!")
 
-    datamap = {}
+    # The warps are independent and GDAL releases the GIL while warping so
+    # they are run concurrently in threads, each with a single threaded warper
+    # so that the pool is the only source of parallelism. The clipped data is
+    # loaded once so that it is shared by all the models that use it, the
+    # warped file is only needed until then so it is kept in memory and
+    # removed straight away.
 
-    obssr = osr.SpatialReference()
-    obssr.ImportFromProj4(obsprj)
-
-    for afn in inputfns:
-        ofn = f"{tmpdir}/{uuid.uuid4()}"
-
-        fd = gdal.Open(afn)
-        geo = fd.GetGeoTransform()
-        prj = fd.GetProjection()
-
-        insr = osr.SpatialReference()
-        insr.ImportFromProj4(prj)
-
-        insr_to_obssr = osr.CoordinateTransformation(insr, obssr)
-        poly = polygon_from_geobox(geo, fd.RasterXSize, fd.RasterYSize)
-        poly.Transform(insr_to_obssr)
-
-        if not poly.Intersects(obspoly):
-            raise InputDataError(f"Input data '{afn}' does not intersect observation.")
+    def warp_and_load(afn):
+        ofn = warp_ancillary(afn, f"/vsimem/{uuid.uuid4()}.tif", clipshpfn, obsprj, obspoly)
+        try:
+            return load_raster(ofn, xsize, ysize)
+        finally:
+            gdal.Unlink(ofn)
 
-        log(f"Clipping and warping input '{afn}' to '{ofn}'")
+    rasters = dict(zip(inputfns, pool.map(warp_and_load, inputfns)))
 
-        fd = gdal.Warp(ofn, fd, cutlineDSName=clipshpfn, cropToCutline=True, dstSRS=obsprj)
+    # Outputs of models are loaded by filename when they are first used.
 
-        datamap[afn] = ofn
+    datamap = {}
 
     # Get processing configuration parameters
 
@@ -702,6 +1009,12 @@ def run(
         log(f"Scaling observation data by {obsscale}")
         obsdata *= float(obsscale)
 
+    # The mask and observation are shared by all the models so they are made
+    # read-only. A model that needs to modify its inputs must copy them.
+
+    mask.setflags(write=False)
+    obsdata.setflags(write=False)
+
     log("# Applying loaded models to data")
 
     for model, m in zip(loaded_models, models):
@@ -730,18 +1043,19 @@ def run(
         # Prepare all the appropriate ancillary data sets and pass the
         # observation data as the last one in the list.
 
-        datas = [mask.copy()]
+        datas = [mask]
 
         outfn = m["output"]
         inputfns = m["inputs"]
 
         log("Loading model inputs:")
         for ip in inputfns:
-            fn = datamap[ip["filename"]]
+            fn = ip["filename"]
 
-            fd = gdal.Open(fn)
+            if fn not in rasters:
+                rasters[fn] = load_raster(datamap[fn], xsize, ysize)
 
-            geo = fd.GetGeoTransform()
+            data, nodata, descs, geo, pnan = rasters[fn]
 
             # First assume bands are the same as source
             ipbands = source.bands
@@ -750,55 +1064,43 @@ def run(
                 ipbands = ip["bands"]
             except KeyError:
                 # If that fails, try to get bandnames from file
-                fbands = []
-                for i in range(fd.RasterCount):
-                    rb = fd.GetRasterBand(i + 1)
-                    desc = rb.GetDescription()
-                    if len(desc) > 0:
-                        fbands.append(desc)
-                if len(fbands) == fd.RasterCount:
-                    ipbands = fbands
-
-            log(f" - path:    {ip['filename']}")
+                if all(len(desc) > 0 for desc in descs):
+                    ipbands = descs
+
+            log(f" - path:    {fn}")
             log(f"   bands:   {','.join(ipbands)}")
 
             notreq = set(source.bands) - set(bands)
             toload = [b for b in ipbands if b not in notreq]
-            bandidx = [i + 1 for i, b in zip(range(fd.RasterCount), ipbands) if b not in notreq]
+            bandidx = [i for i, b in zip(range(data.shape[0]), ipbands) if b not in notreq]
             log(f"   loading: {','.join(toload)}")
 
-            nbands = len(bandidx)
+            if pnan > 0.9:
+                warning(f"clipped input '{fn}' has more than 90% no data")
 
-            data = np.empty((ysize, xsize, nbands), dtype=np.float32)
-            for i, bi in enumerate(bandidx):
-                band = fd.GetRasterBand(bi)
-                band.ReadAsArray(
-                    buf_type=gdal.GDT_Float32,
-                    buf_xsize=xsize,
-                    buf_ysize=ysize,
-                    buf_obj=data[:, :, i],
-                )
+            # Select the bands from the shared data, this is only a copy if
+            # some of the bands are not required.
 
-            nodata = fd.GetRasterBand(1).GetNoDataValue()
-            data[data == nodata] = np.nan
-
-            nnan = np.count_nonzero(np.isnan(data))
-            nval = xsize * ysize * nbands
-            pnan = nnan / nval
-            if pnan > 0.9:
-                warning(f"clipped input '{afn}' has more than 90% no data")
+            if bandidx != list(range(data.shape[0])):
+                data = data[bandidx]
 
             scale = ip.pop("scale", None)
             if scale is not None:
                 log(f"   scaling: {scale}")
-                data *= scale
+
+            data = as_float(data, nodata, scale)
 
             log(f"   data min: {np.nanmin(data)} max: {np.nanmax(data)}")
             log(f"   pixel resolution: {geo[1]:.4f} x {geo[5]:.4f}")
 
-            datas.append(data)
+            data.setflags(write=False)
 
-        datas.append(obsdata)
+            # Data is stored band-first but models expect (ysize, xsize, nbands)
+            # so they are given a transposed view rather than a copy.
+
+            datas.append(data.transpose(1, 2, 0))
+
+        datas.append(obsdata.transpose(1, 2, 0))
 
         log(f"Output: {outfn}")
 
@@ -815,6 +1117,7 @@ def run(
         model.predict_and_save(outfn, *datas)
 
         datamap[outfn] = outfn
+        rasters.pop(outfn, None)
 
         log("Finished running predictions")
 
@@ -828,6 +1131,65 @@ def run(
         gdal.Unlink(fn)
 
 
+def prefix_outputs(args: dict, pkg: str) -> dict:
+    """
+    Return a copy of 'args' where the names of the files written when processing
+    an observation are prefixed with the package name 'pkg'. Model inputs that
+    are the outputs of other models are renamed to match.
+    """
+    args = deepcopy(args)
+
+    def prefix(fn):
+        head, tail = os.path.split(fn)
+        return os.path.join(head, f"{pkg}_{tail}")
+
+    for k in ["obstmp", "masktmp", "clipshpfn"]:
+        args[k] = prefix(args[k])
+
+    outputs = {m["output"]: prefix(m["output"]) for m in args["models"]}
+
+    for m in args["models"]:
+        m["output"] = outputs[m["output"]]
+        for ip in m["inputs"]:
+            ip["filename"] = outputs.get(ip["filename"], ip["filename"])
+
+    return args
+
+
+def run_many(urls: list, njobs: int = None, **args):
+    """
+    Run on each of the observations in 'urls' in separate worker processes.
+    The files written for each observation are prefixed with its package name
+    so that the runs do not overwrite each other. By default half of the CPUs
+    are used for workers and the CPUs are shared between the threads of their
+    runs.
+    """
+    if njobs is None:
+        njobs = min(len(urls), max(1, os.cpu_count() // 2))
+
+    nthreads = args.pop("nthreads", None) or max(1, os.cpu_count() // njobs)
+
+    args.pop("url", None)
+
+    # The GDAL configuration set by `check_config` only applies to this process
+    # so it is passed to the workers through the environment.
+
+    os.environ.update(args.get("gdalconfig", {}))
+
+    # When run as a script `run` belongs to `__main__`, which loky would pickle
+    # by value so that the workers never import this module and its GDAL
+    # settings (e.g. `UseExceptions`). The workers are given the `run` of the
+    # importable module instead.
+
+    worker = importlib.import_module("nrtpredict").run
+
+    log(f"# Processing {len(urls)} observations with {njobs} workers of {nthreads} threads")
+
+    Parallel(n_jobs=njobs, backend="loky")(
+        delayed(worker)(url=url, nthreads=nthreads, **prefix_outputs(args, parse_pkg(url))) for url in urls
+    )
+
+
 def astuple(v):
     """
     Cast to tuple but handle the case where 'v' could be a
@@ -854,6 +1216,7 @@ def check_config(args):
         ("quiet", False),
         ("product", "NBAR"),
         ("obstmp", "/tmp/obs.tif"),
+        ("masktmp", "mask.tif"),
         ("clipshpfn", "/tmp/clip.json"),
         ("tmpdir", "/tmp"),
         ("nocleanup", False),
@@ -868,11 +1231,17 @@ def check_config(args):
 
     # Set GDAL config
 
+    for k, v in GDAL_DEFAULTS:
+        if k not in args["gdalconfig"] and gdal.GetConfigOption(k) is None:
+            args["gdalconfig"][k] = v
+
     for k, v in args["gdalconfig"].items():
         if v == True:
             v = "YES"
         if v == False:
             v = "NO"
+        v = str(v)
+        args["gdalconfig"][k] = v
         gdal.SetConfigOption(k, v)
         log(f"GDAL option {k} = {v}")
 
@@ -895,18 +1264,20 @@ def check_config(args):
 
         if name[:7] == "file://":
             try:
-                path = name[7:]
-                path, checksum = path.split(":")
-            except ValueError:
+                path, algo, checksum = parse_checksum(name[7:])
+                get_hasher(algo)
+            except ValueError as e:
                 log(f"Incorrect model name format, it should be file://filename:sha256checksum")
+                log(f"or file://filename:algo=checksum ({e})")
                 errors = True
 
         if name[:5] == "s3://":
             try:
-                path = name[5:]
-                path, checksum = path.split(":")
-            except ValueError:
+                path, algo, checksum = parse_checksum(name[5:])
+                get_hasher(algo)
+            except ValueError as e:
                 log(f"Incorrect model name format, it should be s3://bucket/key:sha256checksum")
+                log(f"or s3://bucket/key:algo=checksum ({e})")
                 errors = True
 
         if "driver" not in m:
@@ -964,10 +1335,11 @@ def cli_entry(url=None, **kwargs):
     parser = argparse.ArgumentParser()
 
     if url is None:
-        parser.add_argument("url")
+        parser.add_argument("url", nargs="?")
 
     parser.add_argument("-config", default="nrtpredict.yaml", metavar=("yamlfile"))
     parser.add_argument("-tilewidth", default=None)
+    parser.add_argument("-urls", nargs="+", default=None, metavar=("url"))
 
     # ...
 
@@ -976,6 +1348,9 @@ def cli_entry(url=None, **kwargs):
     if url:
         args["url"] = url
 
+    if args["url"] is None and args["urls"] is None:
+        parser.error("a url or -urls is required")
+
     # Try to load configuration file.
 
     try:
@@ -1006,7 +1381,11 @@ def cli_entry(url=None, **kwargs):
     try:
         args = check_config(args)
 
-        run(**args)
+        urls = args.pop("urls", None)
+        if urls:
+            run_many(urls, **args)
+        else:
+            run(**args)
 
         log("Finished.")
 
@@ -1014,6 +1393,10 @@ def cli_entry(url=None, **kwargs):
         warning(str(e))
         sys.exit(1)
 
+    except IncorrectChecksumError:
+        warning(f"Model has an incorrect checksum, exiting...")
+        sys.exit(1)
+
     except ConnectionError as e:
         warning(f"Connection Error: {e}")
         sys.exit(2)
@@ -11,6 +11,27 @@ def test_empty_config_local(tmp_path):
 
     subprocess.check_call(['./nrtpredict.py', '-c', f, 'data/test/S2A_OPER_MSI_ARD_TL_VGS1_20210205T055002_A029372_T50HMK_N02.09'])
 
+def test_urls_prefix_outputs_local(tmp_path):
+    pkg = "S2A_OPER_MSI_ARD_TL_VGS1_20210205T055002_A029372_T50HMK_N02.09"
+    f = tmp_path / "test.yaml"
+    f.write_text(textwrap.dedent(f"""\n
+    obstmp: {tmp_path}/obs.tif
+    masktmp: {tmp_path}/mask.tif
+    clipshpfn: {tmp_path}/clip.json
+    nocleanup: True
+    gdalconfig:
+      GDAL_DISABLE_READDIR_ON_OPEN: YES
+    models:
+       - name: NoOp
+         output: {tmp_path}/noop.tif
+         driver: GTiff
+    """))
+
+    subprocess.check_call(['./nrtpredict.py', '-c', f, '-urls', f'data/test/{pkg}'])
+
+    for fn in ["obs.tif", "mask.tif", "noop.tif"]:
+        assert os.path.exists(tmp_path / f"{pkg}_{fn}")
+
 #def test_cog_output(tmp_path):
 #    f = tmp_path / "test.yaml"
 #    of = tmp_path / "obs.tif"
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from datetime import datetime
+from nrtpredict import URLParsingError, as_float, count_classes, get_hasher
+from nrtpredict import parse_checksum, parse_obsdate, parse_pkg, parse_url, prefix_outputs
+
+
+def test_count_classes():
+    mask = np.random.default_rng(0).integers(0, 6, size=(50, 40), dtype=np.uint8)
+    assert (count_classes(mask, blocksize=7) == np.bincount(mask.ravel())).all()
+
+
+def test_parse_url():
+    pkg = "S2A_OPER_MSI_ARD_TL_VGS1_20210205T055002_A029372_T50HMK_N02.09"
+    assert parse_url(f"data/test/{pkg}/") == (pkg, datetime(2021, 2, 5, 5, 50, 2))
+    assert parse_pkg(f"/vsis3/dea-public-data/{pkg}") == pkg
+    assert parse_pkg("data/test/nodate") == "nodate"
+    with pytest.raises(URLParsingError):
+        parse_obsdate("data/test/nodate")
+
+
+def test_as_float():
+    data = np.array([[1000, -999], [2000, 0]], dtype=np.int16)
+    result = as_float(data, nodata=-999, scale=0.0001)
+    assert result.dtype == np.float32
+    assert np.isnan(result[0, 1])
+    assert np.allclose(result[[0, 1, 1], [0, 0, 1]], [0.1, 0.2, 0.0])
+
+    data = np.ones((2, 2), dtype=np.float32)
+    assert as_float(data) is data
+
+
+def test_prefix_outputs():
+    args = {
+        "obstmp": "obs.tif",
+        "masktmp": "/tmp/mask.tif",
+        "clipshpfn": "clip.shp",
+        "models": [
+            {"output": "prev.tif", "inputs": []},
+            {"output": "change.tif", "inputs": [{"filename": "prev.tif"}, {"filename": "dem.tif"}]},
+        ],
+    }
+    prefixed = prefix_outputs(args, "PKG")
+    assert prefixed["obstmp"] == "PKG_obs.tif"
+    assert prefixed["masktmp"] == "/tmp/PKG_mask.tif"
+    assert prefixed["clipshpfn"] == "PKG_clip.shp"
+    assert [m["output"] for m in prefixed["models"]] == ["PKG_prev.tif", "PKG_change.tif"]
+    assert prefixed["models"][1]["inputs"] == [{"filename": "PKG_prev.tif"}, {"filename": "dem.tif"}]
+    assert args["models"][1]["inputs"][0]["filename"] == "prev.tif"
+    assert args["obstmp"] == "obs.tif"
+
+
+def test_parse_checksum():
+    assert parse_checksum("model.pkl:abc123") == ("model.pkl", "sha256", "abc123")
+    assert parse_checksum("model.pkl:blake3=abc123") == ("model.pkl", "blake3", "abc123")
+    assert parse_checksum("bucket/key/model.pkl:sha512=abc123") == ("bucket/key/model.pkl", "sha512", "abc123")
+
+
+def test_get_hasher():
+    assert get_hasher().name == "sha256"
+    assert get_hasher("sha512").name == "sha512"
+    with pytest.raises(ValueError):
+        get_hasher("nope")
+    with pytest.raises(ValueError):
+        get_hasher("shake_128")